@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+
+# A persistent index from position hashes (see Game.position_hash) to how the archived games that
+# went through that position ended up.
+#
+# The index is an open addressing hash table in a single file, read through mmap - a lookup touches
+# just the slots it probes, so the index never has to be loaded into memory. Entries are only ever
+# added to or accumulated into, and every archived game is indexed exactly once: the names of the
+# indexed archives are kept in a manifest next to the index, so rebuilding only processes games that
+# were finished since the last build. A build fills a copy of the index which is then swapped in;
+# the index header records how many manifest entries it covers, so an interrupted build leaves
+# neither half-indexed games nor manifest entries that aren't in the index.
+#
+# Usage:
+#   python3 position_index.py build
+#   python3 position_index.py lookup <position hash in hex>
+
+import os
+import sys
+import mmap
+import shutil
+import struct
+from typing import Iterator, Optional, Tuple
+
+from tetris import ARCHIVE_DIR, BOARD_BIN_SIZE
+
+INDEX_PATH = os.path.expanduser("~/.pytris-index")
+
+MAGIC = b"PYTRISIX"
+VERSION = 1
+
+# magic, version, capacity (number of slots, a power of two), used slots, indexed archives
+HEADER = struct.Struct(">8sIIII")
+# position hash (0 marks an empty slot), game count, final score sum, lines to death sum
+SLOT = struct.Struct(">QQQQ")
+
+INITIAL_CAPACITY = 1 << 12
+MAX_LOAD_FACTOR = 0.7
+
+# One archive record is the position hash followed by the output of Game.board_to_bin
+ARCHIVE_RECORD_SIZE = 8 + BOARD_BIN_SIZE
+
+
+class PositionStats:
+    def __init__(self, count, final_score_sum, lines_to_death_sum):
+        self.count = count
+        self.average_final_score = final_score_sum / count
+        self.average_lines_to_death = lines_to_death_sum / count
+
+    def __repr__(self):
+        return "PositionStats(count={}, average_final_score={:.1f}, average_lines_to_death={:.1f})".format(
+            self.count, self.average_final_score, self.average_lines_to_death)
+
+
+def _slot_key(position_hash: int) -> int:
+    # 0 is reserved for empty slots
+    return position_hash or 1
+
+
+class PositionIndex:
+    def __init__(self, path=INDEX_PATH, writable=False):
+        self.path = path
+        self.writable = writable
+        if writable and not os.path.exists(path):
+            self._create(path, INITIAL_CAPACITY)
+        self._file = open(path, "r+b" if writable else "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        magic, version, self.capacity, self.used, self.archives = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("{} is not a pytris position index".format(path))
+
+    @staticmethod
+    def _create(path, capacity, archives=0):
+        with open(path, "wb") as index_file:
+            index_file.write(HEADER.pack(MAGIC, VERSION, capacity, 0, archives))
+            index_file.truncate(HEADER.size + capacity * SLOT.size)
+
+    def _write_header(self):
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, self.capacity, self.used, self.archives)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _find_slot(self, key: int) -> Tuple[int, int]:
+        """Returns the offset of the slot holding the key, or of the empty slot it would be put in,
+        along with the key currently in that slot."""
+        slot = key & (self.capacity - 1)
+        while True:
+            offset = HEADER.size + slot * SLOT.size
+            slot_key = struct.unpack_from(">Q", self._map, offset)[0]
+            if slot_key == key or slot_key == 0:
+                return offset, slot_key
+            slot = (slot + 1) & (self.capacity - 1)
+
+    def lookup(self, position_hash: int) -> Optional[PositionStats]:
+        offset, slot_key = self._find_slot(_slot_key(position_hash))
+        if slot_key == 0:
+            return None
+        _, count, final_score_sum, lines_to_death_sum = SLOT.unpack_from(self._map, offset)
+        return PositionStats(count, final_score_sum, lines_to_death_sum)
+
+    def _slots(self) -> Iterator[Tuple[int, int, int, int]]:
+        for slot in range(self.capacity):
+            entry = SLOT.unpack_from(self._map, HEADER.size + slot * SLOT.size)
+            if entry[0] != 0:
+                yield entry
+
+    def _grow(self):
+        entries = list(self._slots())
+        self.close()
+
+        new_path = self.path + ".tmp"
+        self._create(new_path, self.capacity * 2, self.archives)
+        with PositionIndex(new_path, writable=True) as grown:
+            for key, count, final_score_sum, lines_to_death_sum in entries:
+                grown._add(key, count, final_score_sum, lines_to_death_sum)
+            grown.flush()
+        os.replace(new_path, self.path)
+
+        self.__init__(self.path, writable=True)
+
+    def _add(self, key, count, final_score_sum, lines_to_death_sum):
+        offset, slot_key = self._find_slot(key)
+        if slot_key == 0:
+            if self.used + 1 > self.capacity * MAX_LOAD_FACTOR:
+                self._grow()
+                self._add(key, count, final_score_sum, lines_to_death_sum)
+                return
+            self.used += 1
+            self._write_header()
+            SLOT.pack_into(self._map, offset, key, count, final_score_sum, lines_to_death_sum)
+        else:
+            _, old_count, old_final_score_sum, old_lines_to_death_sum = SLOT.unpack_from(self._map, offset)
+            SLOT.pack_into(self._map, offset, key, old_count + count, old_final_score_sum + final_score_sum,
+                           old_lines_to_death_sum + lines_to_death_sum)
+
+    def add(self, position_hash: int, final_score: int, lines_to_death: int):
+        if not self.writable:
+            raise ValueError("The position index was opened read-only")
+        self._add(_slot_key(position_hash), 1, final_score, lines_to_death)
+
+    def flush(self):
+        self._map.flush()
+
+
+def read_archive(path) -> Iterator[Tuple[int, int, int]]:
+    """Yields (position hash, points, lines) for every record of an archived game."""
+    with open(path, "rb") as archive_file:
+        data = archive_file.read()
+    for start in range(0, len(data) - ARCHIVE_RECORD_SIZE + 1, ARCHIVE_RECORD_SIZE):
+        record = data[start:start + ARCHIVE_RECORD_SIZE]
+        position_hash = int.from_bytes(record[0:8], byteorder='big')
+        points = int.from_bytes(record[8:16], byteorder='big')
+        lines = int.from_bytes(record[16:20], byteorder='big')
+        yield position_hash, points, lines
+
+
+def build_index(archive_dir=ARCHIVE_DIR, index_path=INDEX_PATH) -> int:
+    """Adds every finished game from archive_dir that isn't indexed yet. Returns how many were added."""
+    manifest_path = index_path + ".manifest"
+    if not os.path.isdir(archive_dir):
+        return 0
+
+    indexed_count = 0
+    if os.path.exists(index_path):
+        with PositionIndex(index_path) as index:
+            indexed_count = index.archives
+    indexed = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest:
+            # Entries past the ones the index covers are left over from an interrupted build
+            indexed = [line.rstrip("\n") for line in manifest][:indexed_count]
+    # Without the names of every indexed game there's no telling which ones to skip, so start over
+    rebuild = len(indexed) < indexed_count
+    if rebuild:
+        indexed = []
+
+    # Games still in progress are named .partial, they get indexed once they're over
+    indexed_names = set(indexed)
+    new_archives = sorted(name for name in os.listdir(archive_dir)
+                          if name.endswith(".bin") and name not in indexed_names)
+    if not new_archives:
+        return 0
+
+    new_index_path = index_path + ".new"
+    if os.path.exists(index_path) and not rebuild:
+        shutil.copyfile(index_path, new_index_path)
+    elif os.path.exists(new_index_path):
+        os.remove(new_index_path)
+
+    with PositionIndex(new_index_path, writable=True) as index:
+        for name in new_archives:
+            records = list(read_archive(os.path.join(archive_dir, name)))
+            if records:
+                _, final_score, final_lines = records[-1]
+                # A game can go through the same position more than once, it's counted at its first visit
+                seen = set()
+                for position_hash, _, lines in records:
+                    if position_hash in seen:
+                        continue
+                    seen.add(position_hash)
+                    index.add(position_hash, final_score, final_lines - lines)
+        index.archives = len(indexed) + len(new_archives)
+        index._write_header()
+        index.flush()
+
+    # The manifest goes first - until the new index is swapped in, its extra entries are ignored
+    new_manifest_path = manifest_path + ".new"
+    with open(new_manifest_path, "w") as manifest:
+        manifest.writelines(name + "\n" for name in indexed + new_archives)
+    os.replace(new_manifest_path, manifest_path)
+    os.replace(new_index_path, index_path)
+
+    return len(new_archives)
+
+
+def main():
+    if len(sys.argv) == 2 and sys.argv[1] == "build":
+        print("Indexed {} new games".format(build_index()))
+    elif len(sys.argv) == 3 and sys.argv[1] == "lookup":
+        try:
+            position_hash = int(sys.argv[2], 16)
+        except ValueError:
+            print("Not a hexadecimal position hash: {}".format(sys.argv[2]))
+            return 1
+        if not os.path.exists(INDEX_PATH):
+            print("No position index at {} - run '{} build' first".format(INDEX_PATH, sys.argv[0]))
+            return 1
+        with PositionIndex() as index:
+            print(index.lookup(position_hash) or "Position not found")
+    else:
+        print("Usage: {} build | lookup <position hash in hex>".format(sys.argv[0]))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+# A server-authoritative host for many concurrent tetris sessions in a single process.
+#
+# Every session is a headless Game driven by commands coming from a remote client. Instead of one
+# pygame timer per game, all sessions are advanced from a single timer wheel running on one asyncio
+# event loop. Sessions whose clients go quiet are first paused and later evicted to a board_to_bin
+# snapshot, and are transparently restored when their client sends another command. Evicted sessions
+# whose client has disconnected are dropped after a while longer.
+#
+# Protocol (newline separated, over TCP):
+#   client -> server: "new", "resume <id>", "left", "right", "rotate", "down", "drop", "pause"
+#   server -> client: "session <id>", "over <points>", "error <reason>"
+#
+# Usage:
+#   python3 server.py [--port PORT]
+#   python3 server.py --load-test CLIENTS [--seconds SECONDS]
+
+import sys
+import time
+import random
+import asyncio
+import argparse
+from typing import Callable, Dict, List, Optional
+
+from tetris import Game, GameOverException
+
+TICKS_PER_SECOND = 50
+TICK_PERIOD = 1 / TICKS_PER_SECOND
+
+WHEEL_SLOTS = 256
+
+IDLE_PAUSE_SECONDS = 10
+IDLE_EVICT_SECONDS = 60
+# Evicted sessions without a connected client are forgotten after this long
+IDLE_DROP_SECONDS = 60 * 60
+IDLE_CHECK_TICKS = TICKS_PER_SECOND
+
+DEFAULT_PORT = 7777
+
+# Weighted so simulated players mostly steer pieces instead of dropping them straight away
+SIMULATED_MOVES = ['left', 'right', 'rotate'] * 3 + ['down'] * 2 + ['drop']
+
+
+class HeadlessGame(Game):
+    """A Game without a screen - all the drawing is skipped and nothing is written to SAVE_PATH."""
+
+    def __init__(self):
+        super().__init__(screen=None, font=None, width=0)
+
+    def display(self, update_screen=True):
+        pass
+
+    def draw_blot(self, blot, row=0, column=0, start_dimensions=None, color=None):
+        pass
+
+    def update_screen(self):
+        pass
+
+    def add_points(self, points):
+        self.points += points
+
+    def save_game(self):
+        # Sessions are snapshotted when they get evicted instead
+        pass
+
+    def archive_position(self):
+        pass
+
+
+COMMANDS: Dict[str, Callable[[Game], None]] = {
+    'left': Game.falling_move_left,
+    'right': Game.falling_move_right,
+    'rotate': Game.falling_rotate_clockwise,
+    'down': Game.soft_drop,
+    'drop': Game.hard_drop,
+}
+
+
+class TimerWheel:
+    """A hashed timer wheel - callbacks are bucketed by the tick they're due on, so advancing the
+    wheel only touches the callbacks that are due (or have to wait for another revolution)."""
+
+    def __init__(self, slots=WHEEL_SLOTS):
+        self._slots: List[List[list]] = [[] for _ in range(slots)]
+        self._position = 0
+        self.ticks = 0
+
+    def schedule(self, delay: int, callback: Callable[[], None]):
+        delay = max(delay, 1)
+        slot = (self._position + delay) % len(self._slots)
+        rounds = (delay - 1) // len(self._slots)
+        self._slots[slot].append([rounds, callback])
+
+    def advance(self):
+        self._position = (self._position + 1) % len(self._slots)
+        self.ticks += 1
+
+        bucket = self._slots[self._position]
+        self._slots[self._position] = []
+
+        due = []
+        for entry in bucket:
+            if entry[0] > 0:
+                entry[0] -= 1
+                self._slots[self._position].append(entry)
+            else:
+                due.append(entry[1])
+
+        for callback in due:
+            callback()
+
+
+class Session:
+    def __init__(self, session_id: int, now: float):
+        self.id = session_id
+        self.game: Optional[HeadlessGame] = HeadlessGame()
+        self.snapshot: Optional[bytes] = None
+        self.last_input = now
+        self.cpu_time = 0.0
+        self.ticks = 0
+        self.over = False
+        self.scheduled = False
+        # Set when the server paused the game because the client went idle, as opposed to the player pausing it
+        self.idle_paused = False
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    def is_evicted(self) -> bool:
+        return self.game is None
+
+    def is_running(self) -> bool:
+        return not self.over and not self.is_evicted() and not self.game.paused
+
+    def _metered(self, action: Callable[[], None]):
+        start = time.process_time()
+        try:
+            action()
+        except GameOverException:
+            self.over = True
+        self.cpu_time += time.process_time() - start
+
+    def tick(self):
+        self._metered(self.game.do_tick)
+        self.ticks += 1
+
+    def apply(self, command: str):
+        if command == 'pause':
+            self.game.paused = not self.game.paused
+        elif self.game.paused or self.game.running_elision_animation:
+            pass  # Same as the local game - ignore moves while paused or animating elision
+        else:
+            self._metered(lambda: COMMANDS[command](self.game))
+
+    def evict(self):
+        # board_to_bin can't hold an elision in progress, so remove the elided rows before snapshotting
+        self.game.finish_elision()
+        self.snapshot = bytes(self.game.board_to_bin())
+        self.game = None
+
+    def restore(self):
+        self.game = HeadlessGame()
+        self.game.bin_to_board(self.snapshot)
+        # Only paused games get evicted
+        self.game.paused = True
+        self.snapshot = None
+
+
+class SessionHost:
+    def __init__(self, idle_pause=IDLE_PAUSE_SECONDS, idle_evict=IDLE_EVICT_SECONDS, idle_drop=IDLE_DROP_SECONDS):
+        self.sessions: Dict[int, Session] = {}
+        self.wheel = TimerWheel()
+        self.idle_pause = idle_pause
+        self.idle_evict = idle_evict
+        self.idle_drop = idle_drop
+        self.games_over = 0
+        self.evictions = 0
+        self.drops = 0
+        self.late_ticks = 0
+        self._next_session_id = 1
+        self.wheel.schedule(IDLE_CHECK_TICKS, self._check_idle)
+
+    def new_session(self) -> Session:
+        session = Session(self._next_session_id, time.monotonic())
+        self._next_session_id += 1
+        self.sessions[session.id] = session
+        self._schedule_tick(session)
+        return session
+
+    def _schedule_tick(self, session: Session):
+        if session.scheduled or not session.is_running():
+            return
+        session.scheduled = True
+        self.wheel.schedule(1, lambda: self._tick(session))
+
+    def _tick(self, session: Session):
+        session.scheduled = False
+        if not session.is_running():
+            return  # Paused or evicted since it was scheduled - input will schedule it again
+        session.tick()
+        if session.over:
+            self._end_session(session)
+        else:
+            self._schedule_tick(session)
+
+    def _end_session(self, session: Session):
+        self.games_over += 1
+        del self.sessions[session.id]
+        if session.writer is not None and not session.writer.is_closing():
+            session.writer.write(("over %d\n" % session.game.points).encode())
+
+    def _check_idle(self):
+        now = time.monotonic()
+        for session in list(self.sessions.values()):
+            idle_for = now - session.last_input
+            if session.is_evicted():
+                disconnected = session.writer is None or session.writer.is_closing()
+                if disconnected and idle_for >= self.idle_drop:
+                    del self.sessions[session.id]
+                    self.drops += 1
+                continue
+            if idle_for >= self.idle_pause and not session.game.paused:
+                session.game.paused = True
+                session.idle_paused = True
+            if idle_for >= self.idle_evict:
+                session.evict()
+                self.evictions += 1
+        self.wheel.schedule(IDLE_CHECK_TICKS, self._check_idle)
+
+    def handle_input(self, session: Session, command: str):
+        session.last_input = time.monotonic()
+        if session.is_evicted():
+            session.restore()
+        if session.idle_paused:
+            session.idle_paused = False
+            session.game.paused = False
+            if command == 'pause':
+                # The player is resuming a game that looks paused to them - don't toggle it back
+                self._schedule_tick(session)
+                return
+        session.apply(command)
+        if session.over:
+            self._end_session(session)
+        else:
+            self._schedule_tick(session)
+
+    async def run_timer(self):
+        loop = asyncio.get_event_loop()
+        next_tick = loop.time()
+        while True:
+            self.wheel.advance()
+            next_tick += TICK_PERIOD
+            delay = next_tick - loop.time()
+            if delay < 0:
+                self.late_ticks += 1
+            await asyncio.sleep(max(delay, 0))
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = None
+
+        def switch_to(new_session: Session):
+            nonlocal session
+            # The previous session no longer has a client, so it can get dropped when idle
+            if session is not None and session.writer is writer:
+                session.writer = None
+            session = new_session
+            session.writer = writer
+            writer.write(("session %d\n" % session.id).encode())
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                words = line.decode(errors='replace').split()
+                if not words:
+                    continue
+
+                if words[0] == 'resume' and len(words) == 2:
+                    try:
+                        resumed = self.sessions.get(int(words[1]))
+                    except ValueError:
+                        resumed = None
+                    if resumed is None:
+                        writer.write(b"error no such session\n")
+                        continue
+                    switch_to(resumed)
+                    continue
+
+                if session is None or session.over or words[0] == 'new':
+                    switch_to(self.new_session())
+
+                if words[0] == 'new':
+                    continue
+                if words[0] != 'pause' and words[0] not in COMMANDS:
+                    writer.write(b"error unknown command\n")
+                    continue
+
+                self.handle_input(session, words[0])
+        except ConnectionError:
+            pass
+        finally:
+            if session is not None and session.writer is writer:
+                session.writer = None
+            writer.close()
+
+    def stats(self) -> str:
+        sessions = list(self.sessions.values())
+        running = sum(1 for session in sessions if session.is_running())
+        evicted = sum(1 for session in sessions if session.is_evicted())
+        cpu_times = [session.cpu_time for session in sessions] or [0.0]
+        return ("sessions={} running={} paused={} evicted={} games_over={} evictions={} drops={} "
+                "wheel_ticks={} late_ticks={} cpu_ms_per_session(avg={:.2f}, max={:.2f})").format(
+            len(sessions), running, len(sessions) - running - evicted, evicted, self.games_over,
+            self.evictions, self.drops, self.wheel.ticks, self.late_ticks,
+            1000 * sum(cpu_times) / len(cpu_times), 1000 * max(cpu_times))
+
+
+async def report_stats(host: SessionHost, every: float):
+    while True:
+        await asyncio.sleep(every)
+        print(host.stats())
+
+
+async def serve(host: SessionHost, port: int):
+    await asyncio.start_server(host.handle_client, '127.0.0.1', port)
+    print("Listening on 127.0.0.1:{}".format(port))
+    await asyncio.gather(host.run_timer(), report_stats(host, 10))
+
+
+async def simulated_client(port: int, seconds: float, idle_fraction: float):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+    async def discard_output():
+        while await reader.readline():
+            pass
+
+    output_task = asyncio.ensure_future(discard_output())
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + seconds
+    # Some clients stop sending input part way through, so their sessions get paused and evicted.
+    # Half of those also disconnect, so their sessions get dropped too.
+    goes_idle_at = loop.time() + random.uniform(0, seconds / 2) if random.random() < idle_fraction else deadline
+    disconnects = random.random() < 0.5
+
+    writer.write(b"new\n")
+    while loop.time() < goes_idle_at:
+        writer.write((random.choice(SIMULATED_MOVES) + "\n").encode())
+        await writer.drain()
+        await asyncio.sleep(random.uniform(0.05, 0.5))
+
+    if disconnects:
+        writer.close()
+        output_task.cancel()
+    await asyncio.sleep(max(deadline - loop.time(), 0))
+    if not disconnects:
+        writer.close()
+        output_task.cancel()
+
+
+async def load_test(host: SessionHost, port: int, clients: int, seconds: float):
+    server = await asyncio.start_server(host.handle_client, '127.0.0.1', port)
+    timer = asyncio.ensure_future(host.run_timer())
+    reporter = asyncio.ensure_future(report_stats(host, 5))
+
+    await asyncio.gather(*[simulated_client(port, seconds, idle_fraction=0.3) for _ in range(clients)])
+
+    timer.cancel()
+    reporter.cancel()
+    server.close()
+    await server.wait_closed()
+    print(host.stats())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Host many pytris sessions in a single process")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--load-test', type=int, metavar='CLIENTS',
+                        help="run the server with this many simulated local clients, then exit")
+    parser.add_argument('--seconds', type=float, default=30, help="load test duration")
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        if args.load_test:
+            # Idle thresholds scaled down so pausing, eviction and dropping happen within the test's duration
+            host = SessionHost(idle_pause=args.seconds / 10, idle_evict=args.seconds / 5,
+                               idle_drop=args.seconds / 3)
+            loop.run_until_complete(load_test(host, args.port, args.load_test, args.seconds))
+        else:
+            loop.run_until_complete(serve(SessionHost(), args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,6 +2,7 @@
 
 import os
 import sys
+import time
 import random
 import pygame
 from enum import Enum
@@ -23,6 +24,22 @@ SCREEN_WIDTH = 1200
 REMOTE_GAME_LEFT_MARGIN = START_LEFT + BOX_DIMENSION * (GAME_WIDTH + 5)
 
 SAVE_PATH = os.path.expanduser("~/.pytris-save")
+# The archive of the saved game, so a loaded game keeps being archived into the same file
+SAVE_ARCHIVE_PATH = SAVE_PATH + "-archive"
+ARCHIVE_DIR = os.path.expanduser("~/.pytris-archive")
+
+# Points, lines and level, then two blots per byte, then the index of the falling center blot
+BOARD_BIN_SIZE = 16 + (GAME_HEIGHT * GAME_WIDTH) // 2 + 1
+NO_CENTER_BLOT = 0xff
+
+# Zobrist keys for every board cell, hashing which cells hold placed blots. The generator is seeded
+# so that hashes stay the same between runs - they are persisted in the position index.
+ZOBRIST_SEED = 0x7e7215
+_zobrist_random = random.Random(ZOBRIST_SEED)
+ZOBRIST_KEYS = [[_zobrist_random.getrandbits(64) for _ in range(GAME_WIDTH)] for _ in range(GAME_HEIGHT)]
+# What to xor into the hash to move a placed blot one row down
+ZOBRIST_ROW_SHIFT = [[ZOBRIST_KEYS[row][col] ^ ZOBRIST_KEYS[row + 1][col] for col in range(GAME_WIDTH)]
+                     for row in range(GAME_HEIGHT - 1)]
 
 def quit():
     pygame.display.quit()
@@ -141,6 +158,9 @@ class Blot:
     def to_placed_blot(self):  # -> Blot  # (Uncomment if Python 3.7 can be used)
         return Blot(BlotType.PLACED, piece=self._piece)
 
+    def to_center_blot(self):  # -> Blot
+        return Blot(self._type, piece=self._piece, is_center_blot=True)
+
     def should_rotate(self) -> bool:
         return self._piece is not None and not self._piece.no_rotation
 
@@ -173,6 +193,9 @@ class Game:
         self.elision_animation_generator = None
         self.start_left = start_left
         self.width = width
+        self.position_hash = 0
+        self.archive_path = None
+        self.position_archived = True
         for _ in range(GAME_HEIGHT):
             self.board.append([Blot(BlotType.EMPTY)] * GAME_WIDTH)
 
@@ -286,12 +309,14 @@ class Game:
 
         # Simulate a full fall, grab the fallen blocks coordinates, then back the board to its original state
         board = self.board_copy()
+        position_hash, position_archived = self.position_hash, self.position_archived
 
         while self.has_falling_tetrimono():
             falling = [(row, col, blot) for row, col, blot in self.all_blots if blot.is_falling()]
             self.do_fall()
 
         self.board = board
+        self.position_hash, self.position_archived = position_hash, position_archived
 
         return falling
 
@@ -357,6 +382,8 @@ class Game:
         for row, col, blot in self.all_blots:
             if blot.is_falling():
                 self.board[row][col] = blot.to_placed_blot()
+                self.position_hash ^= ZOBRIST_KEYS[row][col]
+                self.position_archived = False
 
     def has_falling_tetrimono(self):
         for row in self.board:
@@ -391,10 +418,25 @@ class Game:
             yield
 
         for rowid in rows_to_elide:
+            # Keep the position hash up to date: the elided row disappears and every row above moves down
+            for col in range(GAME_WIDTH):
+                if self.board[rowid][col].is_placed():
+                    self.position_hash ^= ZOBRIST_KEYS[rowid][col]
+            for row in range(rowid):
+                for col in range(GAME_WIDTH):
+                    if self.board[row][col].is_placed():
+                        self.position_hash ^= ZOBRIST_ROW_SHIFT[row][col]
+
             del self.board[rowid]
             self.board.insert(0, [Blot(BlotType.EMPTY)] * GAME_WIDTH)
 
 
+    def finish_elision(self):
+        if self.running_elision_animation:
+            for _ in self.elision_animation_generator:
+                pass
+            self.running_elision_animation = False
+
     def elide_tetrises(self):
         rows_to_elide = []
 
@@ -411,8 +453,35 @@ class Game:
             self.elision_animation_generator = self.animate_elision(rows_to_elide)
 
     def save_game(self):
+        self.archive_position()
         with open(SAVE_PATH, "wb") as save_file:
             save_file.write(self.board_to_bin())
+        with open(SAVE_ARCHIVE_PATH, "w") as save_archive_file:
+            save_archive_file.write(self.archive_path or "")
+
+    # Every game is archived as a sequence of (position hash, board_to_bin) records, which the
+    # position index is built from. The file only gets its final name once the game is over.
+    # A position is archived once per locked piece, after the elided rows are gone.
+    def archive_position(self):
+        if self.position_archived or self.running_elision_animation:
+            return
+        self.position_archived = True
+        if self.archive_path is None:
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            archive_name = "{}-{}.partial".format(int(time.time() * 1000000), os.getpid())
+            self.archive_path = os.path.join(ARCHIVE_DIR, archive_name)
+        with open(self.archive_path, "ab") as archive_file:
+            archive_file.write(self.position_hash.to_bytes(8, byteorder='big') + self.board_to_bin())
+
+    def finish_archive(self):
+        # A drop that elided rows spawns the next piece before the elision is over, so if that piece
+        # didn't fit the final position hasn't been archived yet
+        self.finish_elision()
+        self.archive_position()
+        if self.archive_path is None:
+            return
+        os.replace(self.archive_path, self.archive_path[:-len(".partial")] + ".bin")
+        self.archive_path = None
 
     def do_tick(self):
         if self.running_elision_animation:
@@ -420,6 +489,7 @@ class Game:
                 next(self.elision_animation_generator)
             except StopIteration:
                 self.running_elision_animation = False
+                self.archive_position()
         elif self.frame % self.frames_per_gridcell() == 0:
             if self.has_falling_tetrimono():
                 self.do_fall()
@@ -431,6 +501,21 @@ class Game:
             # self.display_text()
         self.frame += 1
 
+    def soft_drop(self):
+        if self.do_fall():
+            self.add_points(1)
+            self.elide_tetrises()
+            self.save_game()
+            self.put_new_tetrimono()
+
+    def hard_drop(self):
+        if self.has_falling_tetrimono():
+            while not self.do_fall():
+                self.add_points(1)
+            self.elide_tetrises()
+            self.save_game()
+            self.put_new_tetrimono()
+
     def board_copy(self):
         return [row.copy() for row in self.board]
 
@@ -490,14 +575,11 @@ class Game:
                 yield (row, col, self.board[row][col])
 
     def falling_get_center_blot(self) -> Tuple[int, int, Optional[Blot]]:
-        if not self.has_falling_tetrimono():
-            return 0, 0, None
-
-        return [
-            (row, col, blot)
-            for row, col, blot in self.all_blots
-            if blot.is_falling() and blot.is_center_blot()
-        ][0]
+        # Saves from before board_to_bin stored the center blot load falling pieces without one
+        for row, col, blot in self.all_blots:
+            if blot.is_falling() and blot.is_center_blot():
+                return row, col, blot
+        return 0, 0, None
 
     def is_falling(self, row: int, col: int) -> bool:
         if not 0 <= row < GAME_HEIGHT or not 0 <= col < GAME_WIDTH:
@@ -541,8 +623,9 @@ class Game:
                 out += bytes([blot.get_color_id() << 4])
             else:  # every second blot starting from the second one
                 out[-1] |= blot.get_color_id()
+        center_row, center_col, center_blot = self.falling_get_center_blot()
+        out += bytes([center_row * GAME_WIDTH + center_col if center_blot else NO_CENTER_BLOT])
         return out
-        # TODO: points, center piece location (there's only one - should fit in a byte(?))
 
 
     @staticmethod
@@ -560,22 +643,40 @@ class Game:
         self.board[i // GAME_WIDTH][i % GAME_WIDTH] = blot
 
 
+    def compute_position_hash(self):
+        position_hash = 0
+        for row, col, blot in self.all_blots:
+            if blot.is_placed():
+                position_hash ^= ZOBRIST_KEYS[row][col]
+        return position_hash
+
     def bin_to_board(self, data):
-        EXPECTED_SIZE = 16 + (GAME_HEIGHT * GAME_WIDTH) // 2
-        if len(data) != EXPECTED_SIZE:
-            print("Wrong save file size! Expected {} but got {}.".format(EXPECTED_SIZE, len(data)))
+        # Saves from older versions don't have the center blot byte
+        if len(data) not in (BOARD_BIN_SIZE, BOARD_BIN_SIZE - 1):
+            print("Wrong save file size! Expected {} but got {}.".format(BOARD_BIN_SIZE, len(data)))
             return
         self.points = int.from_bytes(data[0:8], byteorder='big')
         self.lines = int.from_bytes(data[8:12], byteorder='big')
         self.level = int.from_bytes(data[12:16], byteorder='big')
-        for i, byte in enumerate(data[16:]):
+        for i, byte in enumerate(data[16:16 + (GAME_HEIGHT * GAME_WIDTH) // 2]):
             i *= 2  # every byte has 2 blots in it
             self.set_blot_by_index(i, self.blot_from_id(byte >> 4))
             self.set_blot_by_index(i + 1, self.blot_from_id(byte & 0b1111))
+        if len(data) == BOARD_BIN_SIZE and data[-1] < GAME_HEIGHT * GAME_WIDTH:
+            center_row, center_col = data[-1] // GAME_WIDTH, data[-1] % GAME_WIDTH
+            if self.board[center_row][center_col].is_falling():
+                self.board[center_row][center_col] = self.board[center_row][center_col].to_center_blot()
+        self.position_hash = self.compute_position_hash()
 
     def try_load(self):
         with open(SAVE_PATH, "rb") as save_file:
             self.bin_to_board(save_file.read())
+        if os.path.exists(SAVE_ARCHIVE_PATH):
+            with open(SAVE_ARCHIVE_PATH) as save_archive_file:
+                archive_path = save_archive_file.read()
+            # Once the game is over its archive has been renamed, and a loaded game gets a new one
+            if archive_path and os.path.exists(archive_path):
+                self.archive_path = archive_path
 
 MenuResult = Enum('MenuResult', ['new_game', 'load_game'])
 def menu(screen, font):
@@ -673,25 +774,16 @@ def main():
                     game.falling_rotate_clockwise()
 
                 elif key == pygame.K_DOWN:
-                    if game.do_fall():
-                        game.add_points(1)
-                        game.elide_tetrises()
-                        game.save_game()
-                        game.put_new_tetrimono()
+                    game.soft_drop()
 
                 elif key == pygame.K_SPACE:
-                    if game.has_falling_tetrimono():
-                        while not game.do_fall():
-                            game.add_points(1)
-                        game.elide_tetrises()
-                        game.save_game()
-                        game.put_new_tetrimono()
+                    game.hard_drop()
 
                 #game.display_text()
                 # Clear the whole screen
                 game.display()
     except GameOverException:
-        pass
+        game.finish_archive()
 
 if __name__ == '__main__':
     while True: